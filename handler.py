@@ -3,24 +3,54 @@ ComfyUI LTX-2.3 Video Serverless Handler for RunPod
 Supports two modes:
 1. Generated Audio: LTX-2.3 generates audio based on prompt
 2. Custom Audio: Use pre-generated audio (e.g., from ElevenLabs)
+
+The input image may be base64 (optionally a data URI), an http(s):// URL,
+or an s3:// URI; URLs are downloaded straight to disk without a base64 step.
 """
 
 import runpod
 import json
 import urllib.request
+import http.client
 import urllib.error
-import base64
+import urllib.parse
+import ipaddress
+import glob
+import mmap
+import binascii
 import time
 import os
 import sys
 import logging
 import traceback
 import subprocess
+import threading
 from datetime import datetime
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, Callable
+from concurrent.futures import ThreadPoolExecutor, Future
 import random
 import socket
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# pybase64 is a drop-in, SIMD-accelerated replacement for base64
+try:
+    import pybase64 as b64
+except ImportError:
+    import base64 as b64
+
+# PyAV (bundled with ComfyUI) probes and converts audio in-process;
+# without it we fall back to ffprobe/ffmpeg subprocesses
+try:
+    import av
+except ImportError:
+    av = None
+import uuid
+import websocket
+
 class CustomFormatter(logging.Formatter):
     grey = "\x1b[38;20m"
     blue = "\x1b[34;20m"
@@ -36,11 +66,21 @@ class CustomFormatter(logging.Formatter):
         logging.ERROR: red + format_str + reset,
         logging.CRITICAL: bold_red + format_str + reset,
     }
+    def __init__(self):
+        super().__init__()
+        self._formatters = {
+            level: logging.Formatter(fmt, datefmt='%Y-%m-%d %H:%M:%S')
+            for level, fmt in self.FORMATS.items()
+        }
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt, datefmt='%Y-%m-%d %H:%M:%S')
+        formatter = self._formatters.get(record.levelno) or self._formatters[logging.INFO]
         return formatter.format(record)
 
+# Thread/process details are collected on every record but never formatted
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
 def setup_logging():
     logger = logging.getLogger("LTX2-Handler")
     logger.setLevel(logging.DEBUG)
@@ -56,8 +96,25 @@ logger = setup_logging()
 COMFYUI_HOST = "127.0.0.1"
 COMFYUI_PORT = 8188
 COMFYUI_URL = f"http://{COMFYUI_HOST}:{COMFYUI_PORT}"
+COMFYUI_WS_URL = f"ws://{COMFYUI_HOST}:{COMFYUI_PORT}/ws"
+
+READY_PROBE_INITIAL_DELAY = 0.05
+READY_PROBE_MAX_DELAY = 1.0
+READY_PROBE_LOG_INTERVAL = 30.0
+# Backoff for the /history polling fallback when no websocket is available
+COMPLETION_POLL_INITIAL_DELAY = 0.1
+COMPLETION_POLL_MAX_DELAY = 1.0
+# Set by the background readiness probe once /system_stats answers
+COMFYUI_READY = threading.Event()
+
+# Persistent keep-alive connection shared by all ComfyUI HTTP calls
+_HTTP: Optional[http.client.HTTPConnection] = None
+_HTTP_LOCK = threading.Lock()
+
+DEFAULT_NEGATIVE_PROMPT = "static, frozen, no movement, still frame, blurry, jittery, morphing, deformed, warping, extra limbs, bad anatomy, watermark, text, overlay, titles, subtitles, glitch, artifact, low quality, distorted face"
 
 DEFAULT_PARAMS = {
+    "negative_prompt": DEFAULT_NEGATIVE_PROMPT,
     "width": 720,
     "height": 720,
     "frame_count": 97,
@@ -70,8 +127,79 @@ DEFAULT_PARAMS = {
     "i2v_strength_first": 1.0,
     "i2v_strength_second": 1.0
 }
+# Job input fields copied into params; anything else in job_input is ignored
+JOB_PARAM_KEYS = frozenset(DEFAULT_PARAMS) | {"image", "prompt", "audio", "return_format"}
 
-DEFAULT_NEGATIVE_PROMPT = "static, frozen, no movement, still frame, blurry, jittery, morphing, deformed, warping, extra limbs, bad anatomy, watermark, text, overlay, titles, subtitles, glitch, artifact, low quality, distorted face"
+VIDEO_EXTENSIONS = (".mp4", ".webm", ".gif", ".avi", ".mov")
+# SaveVideo node in the bundled templates; it reports its file under "images"
+OUTPUT_VIDEO_NODE = "75"
+OUTPUT_VIDEO_KEYS = ("gifs", "videos", "video", "images", "files")
+REMOTE_INPUT_SCHEMES = ("http://", "https://", "s3://")
+# "base64" embeds the video in the response; "s3" (or "url", the matching
+# return_format) uploads it and returns a presigned URL as video_url. Jobs
+# can override this with return_format.
+OUTPUT_MODE = os.getenv("OUTPUT_MODE", "base64").strip().lower()
+OUTPUT_MODES = {"base64": "base64", "s3": "url", "url": "url"}
+RETURN_FORMATS = ("base64", "url")
+if OUTPUT_MODE not in OUTPUT_MODES:
+    logger.error("Unknown OUTPUT_MODE %r (expected base64, s3 or url); defaulting to base64", OUTPUT_MODE)
+DEFAULT_RETURN_FORMAT = OUTPUT_MODES.get(OUTPUT_MODE, "base64")
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_KEY_PREFIX = os.getenv("S3_KEY_PREFIX", "ltx2-outputs/")
+S3_PRESIGN_EXPIRY_SECONDS = int(os.getenv("S3_PRESIGN_EXPIRY_SECONDS", "3600"))
+_S3_CLIENT = None
+
+MAX_BASE64_INPUT_CHARS = int(os.getenv("MAX_BASE64_INPUT_CHARS", str(64 * 1024 * 1024)))
+BASE64_DECODE_CHUNK_CHARS = 4 * 1024 * 1024
+# Byte limit for URL inputs; defaults to what the base64 cap decodes to
+MAX_INPUT_DOWNLOAD_BYTES = int(os.getenv("MAX_INPUT_DOWNLOAD_BYTES", str(MAX_BASE64_INPUT_CHARS // 4 * 3)))
+DATA_URI_HEADER_MAX_CHARS = 256
+# Optional comma-separated allowlists for URL inputs; empty allows any
+# public host or any bucket the worker's credentials can read
+INPUT_URL_ALLOWED_HOSTS = frozenset(h.strip().lower() for h in os.getenv("INPUT_URL_ALLOWED_HOSTS", "").split(",") if h.strip())
+INPUT_S3_BUCKETS = frozenset(b.strip() for b in os.getenv("INPUT_S3_BUCKETS", "").split(",") if b.strip())
+
+# (node_id, input_key, value_key) assignments applied to each workflow mode.
+# Resize (102) and the spatial upscaler's longer edge (92:106) follow the
+# requested resolution.
+COMMON_PATCHES = (
+    ("98", "image", "image_filename"),
+    ("92:3", "text", "prompt"),
+    ("92:4", "text", "negative_prompt"),
+    ("92:11", "noise_seed", "seed"),
+    ("92:67", "noise_seed", "seed"),
+    ("92:9", "steps", "steps"),
+    ("92:47", "cfg", "cfg"),
+    ("92:97", "fps", "fps"),
+    ("92:99", "img_compression", "img_compression"),
+    ("92:107", "strength", "i2v_strength_first"),
+    ("92:108", "strength", "i2v_strength_second"),
+    ("102", "resize_type.width", "width"),
+    ("102", "resize_type.height", "height"),
+    ("92:106", "longer_edge", "longer_edge"),
+)
+
+GENERATED_AUDIO_PATCHES = COMMON_PATCHES + (
+    ("92:62", "value", "frame_count"),
+    ("92:22", "frame_rate", "fps"),
+    ("92:51", "frame_rate", "fps"),
+)
+
+CUSTOM_AUDIO_PATCHES = COMMON_PATCHES + (
+    ("92:114", "audio", "audio_filename"),
+    ("92:115", "value", "fps_float"),
+)
+
+WORKFLOW_PATCHES = {
+    "generated_audio": GENERATED_AUDIO_PATCHES,
+    "custom_audio": CUSTOM_AUDIO_PATCHES,
+}
+WORKFLOW_NAMES = tuple(WORKFLOW_PATCHES)
+WORKFLOW_TEMPLATES: Dict[str, Dict] = {}
+# Per template: ((node_id, ((input_key, value_key), ...)), ...)
+PatchPlan = Tuple[Tuple[str, Tuple[Tuple[str, str], ...]], ...]
+WORKFLOW_PATCH_PLANS: Dict[str, PatchPlan] = {}
 
 INFRA_FAILURE_WINDOW_SECONDS = int(os.getenv("INFRA_FAILURE_WINDOW_SECONDS", "600"))
 INFRA_FAILURE_THRESHOLD = int(os.getenv("INFRA_FAILURE_THRESHOLD", "3"))
@@ -87,6 +215,18 @@ INFRA_ERROR_CODES = {
 }
 
 
+def json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def json_loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 def _worker_metadata() -> Dict[str, Any]:
     worker_id = (
         os.getenv("RUNPOD_WORKER_ID")
@@ -183,7 +323,15 @@ def _classify_exception(exc: Exception) -> tuple[str, str, bool, bool, bool]:
     if isinstance(exc, TimeoutError):
         return ("WORKFLOW_TIMEOUT", message, True, True, True)
 
-    if isinstance(exc, urllib.error.URLError):
+    if "failed to download input" in lowered:
+        return ("INPUT_DOWNLOAD_FAILED", message, True, False, False)
+
+    if isinstance(exc, OutputUploadError):
+        # Bucket policy or credentials, not the worker: regenerating the
+        # video would hit the same error, and the worker stays healthy
+        return ("OUTPUT_UPLOAD_FAILED", message, False, False, False)
+
+    if isinstance(exc, (urllib.error.URLError, websocket.WebSocketException, ConnectionError, http.client.HTTPException)):
         return ("COMFYUI_UNREACHABLE", message, True, True, True)
 
     if "workflow error" in lowered:
@@ -192,6 +340,9 @@ def _classify_exception(exc: Exception) -> tuple[str, str, bool, bool, bool]:
     if "http error" in lowered and ("prompt" in lowered or "/prompt" in lowered):
         return ("WORKFLOW_QUEUE_FAILED", message, True, True, True)
 
+    if isinstance(exc, (binascii.Error, InputTooLargeError, InputNotAllowedError)):
+        return ("INVALID_INPUT", message, False, False, False)
+
     if "incorrect padding" in lowered or "invalid base64" in lowered:
         return ("INVALID_INPUT", message, False, False, False)
 
@@ -201,10 +352,10 @@ def _classify_exception(exc: Exception) -> tuple[str, str, bool, bool, bool]:
     return ("INTERNAL_ERROR", message, True, True, True)
 
 
-def _success_response(*, video_data: str, seed: Optional[int], elapsed_s: float, extra: Dict[str, Any]) -> Dict[str, Any]:
+def _success_response(*, video_output: Dict[str, str], seed: Optional[int], elapsed_s: float, extra: Dict[str, Any]) -> Dict[str, Any]:
     payload: Dict[str, Any] = {
         "ok": True,
-        "video": video_data,
+        **video_output,
         "seed": seed,
         "worker": _worker_metadata(),
         "timings": {"elapsed_s": elapsed_s},
@@ -218,303 +369,666 @@ def log_separator(char="-", length=80):
 
 def log_section(title: str):
     log_separator("=")
-    logger.info(f"  {title}")
+    logger.info("  %s", title)
     log_separator("=")
 
-def wait_for_comfyui(timeout: int = 120) -> bool:
-    logger.info(f"Waiting for ComfyUI server at {COMFYUI_URL}...")
-    start_time = time.time()
-    while time.time() - start_time < timeout:
+def comfyui_request(method: str, path: str, body: Optional[bytes] = None, timeout: float = 30) -> bytes:
+    """Send a request to ComfyUI over the shared keep-alive connection."""
+    global _HTTP
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    with _HTTP_LOCK:
+        for attempt in range(2):
+            if _HTTP is None:
+                _HTTP = http.client.HTTPConnection(COMFYUI_HOST, COMFYUI_PORT, timeout=timeout)
+            _HTTP.timeout = timeout
+            if _HTTP.sock is not None:
+                _HTTP.sock.settimeout(timeout)
+            try:
+                _HTTP.request(method, path, body=body, headers=headers)
+                response = _HTTP.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.BadStatusLine, http.client.ImproperConnectionState):
+                # ComfyUI drops idle keep-alive sockets, which surfaces as a
+                # reset, an empty status line or a connection left mid-request;
+                # reconnect once
+                _HTTP.close()
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                _HTTP.close()
+                raise
+            if response.status != 200:
+                raise RuntimeError(f"HTTP Error {response.status} for {method} {path}: {data[:500]!r}")
+            return data
+
+def _probe_comfyui_until_ready() -> None:
+    # Probe rapidly at first so a server that is nearly up is noticed
+    # quickly; refused localhost connects are cheap, so cap at 1s
+    delay = READY_PROBE_INITIAL_DELAY
+    # The probe has no deadline, so only log when the failure changes or a
+    # while has passed, instead of once per probe for as long as it runs
+    last_error, last_logged = None, 0.0
+    while not COMFYUI_READY.is_set():
         try:
-            response = urllib.request.urlopen(f"{COMFYUI_URL}/system_stats", timeout=5)
-            if response.status == 200:
-                logger.info("ComfyUI server is ready!")
-                return True
+            comfyui_request("GET", "/system_stats", timeout=5)
+            logger.info("ComfyUI server is ready!")
+            COMFYUI_READY.set()
+            return
         except Exception as e:
-            logger.debug(f"Waiting... ({e})")
-        time.sleep(2)
-    logger.error(f"ComfyUI server did not start within {timeout} seconds")
+            error, now = str(e), time.time()
+            if error != last_error or now - last_logged >= READY_PROBE_LOG_INTERVAL:
+                logger.debug("Waiting... (%s)", error)
+                last_error, last_logged = error, now
+        time.sleep(delay)
+        delay = min(delay * 1.5, READY_PROBE_MAX_DELAY)
+
+def start_readiness_probe() -> None:
+    threading.Thread(target=_probe_comfyui_until_ready, name="comfyui-ready-probe", daemon=True).start()
+
+def wait_for_comfyui(timeout: int = 120) -> bool:
+    if COMFYUI_READY.is_set():
+        return True
+    logger.info("Waiting for ComfyUI server at %s...", COMFYUI_URL)
+    if COMFYUI_READY.wait(timeout):
+        return True
+    logger.error("ComfyUI server did not start within %s seconds", timeout)
     return False
 
+def ensure_io_directories() -> None:
+    # The input and output directories never change; create them once at
+    # startup instead of on every save. A failure is logged rather than
+    # raised so it surfaces as a classified per-job error, not an import crash
+    for directory in ("/comfyui/input", "/comfyui/output"):
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            logger.error("Could not create %s: %s", directory, e)
+
+class InputTooLargeError(ValueError):
+    """An input payload exceeds the configured size limit."""
+
+class InputNotAllowedError(ValueError):
+    """An input URL points somewhere the worker must not fetch from."""
+
+def _decode_base64_to_file(data: str, start: int, filepath: str) -> None:
+    # Decode in blocks of a multiple of 4 characters so each block decodes
+    # independently and only one decoded block is resident at a time.
+    # Write straight to the fd; a BufferedWriter would only add a copy.
+    # No fadvise here: ComfyUI reads the input right after, from page cache
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for offset in range(start, len(data), BASE64_DECODE_CHUNK_CHARS):
+            view = memoryview(b64.b64decode(data[offset:offset + BASE64_DECODE_CHUNK_CHARS], validate=True))
+            while view:
+                view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def write_base64_file(data: str, filepath: str, label: str) -> None:
+    # "base64," can only appear in a data URI header (payloads never contain
+    # a comma), so don't scan a whole raw payload looking for it. find()
+    # with offsets also avoids partition()'s copy of the payload
+    start = data.find("base64,", 0, DATA_URI_HEADER_MAX_CHARS)
+    start = start + 7 if start >= 0 else 0
+    # Reject oversized payloads before writing anything, and fail fast on
+    # stray characters instead of decoding garbage
+    size = len(data) - start
+    if size > MAX_BASE64_INPUT_CHARS:
+        raise InputTooLargeError(f"Input {label} too large: {size} base64 characters (max {MAX_BASE64_INPUT_CHARS})")
+    try:
+        _decode_base64_to_file(data, start, filepath)
+    except binascii.Error:
+        # Line-wrapped base64 (the base64 CLI, base64.encodebytes) fails the
+        # strict decode; drop the whitespace and decode again. Only wrapped
+        # payloads pay for this copy
+        stripped = "".join(data[start:].split())
+        if len(stripped) == size:
+            raise
+        _decode_base64_to_file(stripped, 0, filepath)
+
+def s3_client():
+    global _S3_CLIENT
+    if _S3_CLIENT is None:
+        import boto3
+        _S3_CLIENT = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL)
+    return _S3_CLIENT
+
+def _redact_url(url: str) -> str:
+    # Presigned S3/GCS URLs carry their signature and credentials in the
+    # query string; only scheme, host and path are safe to log or return
+    parsed = urllib.parse.urlsplit(url)
+    return f"{parsed.scheme}://{parsed.netloc.rpartition('@')[2]}{parsed.path}"
+
+def _check_input_host(url: str) -> None:
+    # Callers choose the URL, so keep the worker from fetching its own
+    # services (ComfyUI on loopback), the private network or link-local
+    # metadata endpoints. Every resolved address must be public
+    host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    if not host:
+        raise InputNotAllowedError(f"Input URL has no host: {_redact_url(url)}")
+    if INPUT_URL_ALLOWED_HOSTS and host not in INPUT_URL_ALLOWED_HOSTS:
+        raise InputNotAllowedError(f"Input host not allowed: {host}")
+    for info in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP):
+        address = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+        if not address.is_global:
+            raise InputNotAllowedError(f"Input host not allowed: {host} resolves to non-public address {address}")
+
+class _CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Apply the input host check to every redirect target too."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if not newurl.startswith(("http://", "https://")):
+            raise InputNotAllowedError(f"Input redirected to unsupported URL: {_redact_url(newurl)}")
+        _check_input_host(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+_INPUT_URL_OPENER = urllib.request.build_opener(_CheckedRedirectHandler)
+
+def _copy_input_stream(source: Any, filepath: str, declared_size: Optional[int]) -> None:
+    # Remote inputs get the same ceiling as base64 ones; check the declared
+    # length first, then count bytes in case it was absent or wrong
+    if declared_size is not None and declared_size > MAX_INPUT_DOWNLOAD_BYTES:
+        raise InputTooLargeError(f"Input too large: {declared_size} bytes (max {MAX_INPUT_DOWNLOAD_BYTES})")
+    copied = 0
+    with open(filepath, "wb") as f:
+        while True:
+            chunk = source.read(1024 * 1024)
+            if not chunk:
+                break
+            copied += len(chunk)
+            if copied > MAX_INPUT_DOWNLOAD_BYTES:
+                raise InputTooLargeError(f"Input too large: over {MAX_INPUT_DOWNLOAD_BYTES} bytes")
+            f.write(chunk)
+
+def download_input(url: str, filepath: str) -> None:
+    safe_url = _redact_url(url)
+    logger.info("Downloading input from %s...", safe_url)
+    try:
+        if url.startswith("s3://"):
+            parsed = urllib.parse.urlparse(url)
+            if INPUT_S3_BUCKETS and parsed.netloc not in INPUT_S3_BUCKETS:
+                raise InputNotAllowedError(f"Input bucket not allowed: {parsed.netloc}")
+            obj = s3_client().get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip("/"))
+            with obj["Body"] as body:
+                _copy_input_stream(body, filepath, obj.get("ContentLength"))
+        else:
+            _check_input_host(url)
+            with _INPUT_URL_OPENER.open(url, timeout=60) as response:
+                length = response.headers.get("Content-Length")
+                _copy_input_stream(response, filepath, int(length) if length and length.isdigit() else None)
+    except (InputTooLargeError, InputNotAllowedError):
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Failed to download input from {safe_url}: {e}") from e
+
 def save_input_image(image_data: str, filename: str = "input_image.png") -> str:
     logger.info("Saving input image...")
     try:
-        if "base64," in image_data:
-            image_data = image_data.split("base64,")[1]
-        image_bytes = base64.b64decode(image_data)
         filepath = f"/comfyui/input/{filename}"
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, "wb") as f:
-            f.write(image_bytes)
+        if image_data.startswith(REMOTE_INPUT_SCHEMES):
+            download_input(image_data, filepath)
+        else:
+            write_base64_file(image_data, filepath, "image")
         file_size = os.path.getsize(filepath)
-        logger.info(f"Saved input image to {filepath} ({file_size} bytes)")
+        logger.info("Saved input image to %s (%s bytes)", filepath, file_size)
         return filepath
     except Exception as e:
-        logger.error(f"Failed to save input image: {e}")
+        logger.error("Failed to save input image: %s", e)
         raise
 
+def _probe_audio(filepath: str) -> Tuple[int, Optional[float]]:
+    """Return (channels, duration_seconds) of the first audio stream."""
+    if av is None:
+        # One ffprobe run reports both the stream and the container fields
+        result = subprocess.run([
+            "ffprobe", "-v", "error",
+            "-select_streams", "a:0",
+            "-show_entries", "stream=channels:format=duration",
+            "-of", "json",
+            filepath
+        ], capture_output=True, timeout=30)
+        info = json_loads(result.stdout)
+        duration = info.get("format", {}).get("duration")
+        return int(info["streams"][0]["channels"]), float(duration) if duration else None
+
+    with av.open(filepath) as container:
+        stream = container.streams.audio[0]
+        duration = None
+        if container.duration is not None:
+            duration = float(container.duration) / av.time_base
+        elif stream.duration is not None:
+            duration = float(stream.duration * stream.time_base)
+        return stream.channels, duration
+
+def _convert_to_stereo(src_path: str, dst_path: str) -> None:
+    if av is None:
+        result = subprocess.run([
+            "ffmpeg", "-y", "-i", src_path,
+            "-ac", "2",  # Convert to 2 channels; leaves stereo input as is
+            "-ar", "44100",  # Standard sample rate
+            "-c:a", "pcm_s16le",  # Raw PCM, no encoder on the hot path
+            dst_path
+        ], capture_output=True, text=True, timeout=60)
+        if result.returncode != 0:
+            raise RuntimeError(f"FFmpeg conversion failed: {result.stderr}")
+        return
+
+    with av.open(src_path) as source, av.open(dst_path, "w") as target:
+        out_stream = target.add_stream("pcm_s16le", rate=44100, layout="stereo")
+        resampler = av.AudioResampler(format=out_stream.format, layout="stereo", rate=44100)
+        for frame in source.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                target.mux(out_stream.encode(resampled))
+        for resampled in resampler.resample(None):
+            target.mux(out_stream.encode(resampled))
+        target.mux(out_stream.encode(None))
+
 def save_input_audio(audio_data: str, filename: str = "input_audio.mp3") -> Tuple[str, float]:
     logger.info("Saving input audio...")
     try:
-        if "base64," in audio_data:
-            audio_data = audio_data.split("base64,")[1]
-        audio_bytes = base64.b64decode(audio_data)
         temp_filepath = f"/comfyui/input/temp_{filename}"
         filepath = f"/comfyui/input/{filename}"
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(temp_filepath, "wb") as f:
-            f.write(audio_bytes)
+        write_base64_file(audio_data, temp_filepath, "audio")
         file_size = os.path.getsize(temp_filepath)
-        logger.info(f"Saved temp audio to {temp_filepath} ({file_size} bytes)")
+        logger.info("Saved temp audio to %s (%s bytes)", temp_filepath, file_size)
 
-        # Check number of channels
         try:
-            result = subprocess.run([
-                "ffprobe", "-v", "error",
-                "-select_streams", "a:0",
-                "-show_entries", "stream=channels",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                temp_filepath
-            ], capture_output=True, text=True, timeout=30)
-            channels = int(result.stdout.strip())
-            logger.info(f"Audio channels: {channels}")
+            channels, duration = _probe_audio(temp_filepath)
+            logger.info("Audio channels: %s", channels)
         except Exception as e:
-            logger.warning(f"Could not determine audio channels: {e}")
-            channels = 1  # Assume mono if detection fails
+            logger.warning("Could not probe audio: %s", e)
+            channels, duration = 1, None  # Assume mono if detection fails
 
-        # Convert mono to stereo if needed (LTX-2 Audio VAE requires stereo)
+        # Convert mono to stereo if needed (LTX-2 Audio VAE requires stereo).
+        # The upmix is written as PCM WAV, which the VAE reads as readily as
+        # MP3 and skips a lossy re-encode
         if channels == 1:
             logger.info("Converting mono audio to stereo...")
-            convert_result = subprocess.run([
-                "ffmpeg", "-y", "-i", temp_filepath,
-                "-ac", "2",  # Convert to 2 channels (stereo)
-                "-ar", "44100",  # Standard sample rate
-                filepath
-            ], capture_output=True, text=True, timeout=60)
-            if convert_result.returncode != 0:
-                logger.error(f"FFmpeg conversion failed: {convert_result.stderr}")
-                # Fall back to original file
-                os.rename(temp_filepath, filepath)
-            else:
+            stereo_filepath = f"{os.path.splitext(filepath)[0]}.wav"
+            try:
+                _convert_to_stereo(temp_filepath, stereo_filepath)
                 logger.info("Converted to stereo successfully")
                 os.remove(temp_filepath)
+                filepath = stereo_filepath
+            except Exception as e:
+                logger.error("Stereo conversion failed: %s", e)
+                # Fall back to original file
+                os.rename(temp_filepath, filepath)
         else:
             # Already stereo, just rename
             os.rename(temp_filepath, filepath)
 
-        # Get duration from final file
-        try:
-            result = subprocess.run([
-                "ffprobe", "-v", "error",
-                "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                filepath
-            ], capture_output=True, text=True, timeout=30)
-            duration = float(result.stdout.strip())
-            logger.info(f"Audio duration: {duration:.2f} seconds")
-            return filepath, duration
-        except Exception as e:
-            logger.warning(f"Could not determine audio duration: {e}")
+        # Upmixing keeps the timeline, so the probed duration still applies
+        if duration is None:
+            logger.warning("Could not determine audio duration")
             return filepath, 4.0
+        logger.info("Audio duration: %.2f seconds", duration)
+        return filepath, duration
     except Exception as e:
-        logger.error(f"Failed to save input audio: {e}")
+        logger.error("Failed to save input audio: %s", e)
         raise
 
-def load_workflow(workflow_name: str = "generated_audio") -> Dict:
+def _read_workflow_template(workflow_name: str) -> Dict:
     workflow_path = f"/workflow_{workflow_name}.json"
     if not os.path.exists(workflow_path):
         workflow_path = "/workflow.json"
-    logger.info(f"Loading workflow from {workflow_path}...")
-    try:
-        with open(workflow_path, "r") as f:
-            workflow = json.load(f)
-        logger.info("Workflow loaded successfully")
-        return workflow
-    except Exception as e:
-        logger.error(f"Failed to load workflow: {e}")
-        raise
+    logger.info("Loading workflow from %s...", workflow_path)
+    with open(workflow_path, "rb") as f:
+        return json_loads(f.read())
 
-def modify_workflow_generated_audio(workflow: Dict, params: Dict) -> Dict:
-    logger.info("Configuring workflow for GENERATED AUDIO mode...")
-    seed = params.get("seed")
-    if seed is None or seed == -1:
-        seed = random.randint(0, 2**31 - 1)
-        logger.info(f"Generated random seed: {seed}")
-        params["seed"] = seed
+def _cache_workflow_template(workflow_name: str, template: Dict) -> None:
+    WORKFLOW_TEMPLATES[workflow_name] = template
+    # Specialize the patch table to this deployment's template: dropping
+    # assignments for absent nodes means no membership tests per job, and
+    # grouping them by node means one inputs lookup per node
+    grouped: Dict[str, list] = {}
+    for node_id, input_key, value_key in WORKFLOW_PATCHES.get(workflow_name, ()):
+        if node_id in template:
+            grouped.setdefault(node_id, []).append((input_key, value_key))
+    WORKFLOW_PATCH_PLANS[workflow_name] = tuple(
+        (node_id, tuple(assignments)) for node_id, assignments in grouped.items()
+    )
+
+def preload_workflows() -> None:
+    for workflow_name in WORKFLOW_NAMES:
+        try:
+            _cache_workflow_template(workflow_name, _read_workflow_template(workflow_name))
+        except Exception as e:
+            logger.warning("Could not preload workflow '%s', will load on first use: %s", workflow_name, e)
 
-    if "98" in workflow:
-        workflow["98"]["inputs"]["image"] = "input_image.png"
-    if "92:3" in workflow:
-        workflow["92:3"]["inputs"]["text"] = params["prompt"]
-    if "92:4" in workflow:
-        workflow["92:4"]["inputs"]["text"] = params.get("negative_prompt", DEFAULT_NEGATIVE_PROMPT)
-    for node_id in ["92:11", "92:67"]:
-        if node_id in workflow:
-            workflow[node_id]["inputs"]["noise_seed"] = seed
-    if "92:62" in workflow:
-        workflow["92:62"]["inputs"]["value"] = params["frame_count"]
-    if "92:9" in workflow:
-        workflow["92:9"]["inputs"]["steps"] = params["steps"]
-    if "92:47" in workflow:
-        workflow["92:47"]["inputs"]["cfg"] = params["cfg"]
-    if "92:22" in workflow:
-        workflow["92:22"]["inputs"]["frame_rate"] = params["fps"]
-    if "92:51" in workflow:
-        workflow["92:51"]["inputs"]["frame_rate"] = params["fps"]
-    if "92:97" in workflow:
-        workflow["92:97"]["inputs"]["fps"] = params["fps"]
-    if "92:99" in workflow:
-        workflow["92:99"]["inputs"]["img_compression"] = params.get("img_compression", 33)
-    if "92:107" in workflow:
-        workflow["92:107"]["inputs"]["strength"] = params.get("i2v_strength_first", 1.0)
-    if "92:108" in workflow:
-        workflow["92:108"]["inputs"]["strength"] = params.get("i2v_strength_second", 1.0)
-    # Resolution - resize input image to requested dimensions
-    if "102" in workflow:
-        workflow["102"]["inputs"]["resize_type.width"] = params["width"]
-        workflow["102"]["inputs"]["resize_type.height"] = params["height"]
-    # Spatial upscaler - set longer edge to match requested dimensions
-    if "92:106" in workflow:
-        workflow["92:106"]["inputs"]["longer_edge"] = max(params["width"], params["height"])
+def _workflow_template(workflow_name: str) -> Dict:
+    template = WORKFLOW_TEMPLATES.get(workflow_name)
+    if template is None:
+        try:
+            template = _read_workflow_template(workflow_name)
+        except Exception as e:
+            logger.error("Failed to load workflow: %s", e)
+            raise
+        _cache_workflow_template(workflow_name, template)
+    return template
+
+def load_workflow(workflow_name: str = "generated_audio") -> Dict:
+    template = _workflow_template(workflow_name)
+    # Jobs only ever write to the inputs of patched nodes, so copy just
+    # those and share every other node with the cached template
+    workflow = dict(template)
+    for node_id, _ in WORKFLOW_PATCH_PLANS[workflow_name]:
+        node = dict(template[node_id])
+        node["inputs"] = dict(node["inputs"])
+        workflow[node_id] = node
     return workflow
 
-def modify_workflow_custom_audio(workflow: Dict, params: Dict, audio_duration: float) -> Dict:
-    logger.info("Configuring workflow for CUSTOM AUDIO mode...")
+def patch_plan(workflow_name: str) -> PatchPlan:
+    _workflow_template(workflow_name)
+    return WORKFLOW_PATCH_PLANS[workflow_name]
+
+def _resolve_seed(params: Dict) -> int:
     seed = params.get("seed")
     if seed is None or seed == -1:
         seed = random.randint(0, 2**31 - 1)
-        logger.info(f"Generated random seed: {seed}")
+        logger.info("Generated random seed: %s", seed)
         params["seed"] = seed
+    return seed
+
+def _base_patch_values(params: Dict, seed: int) -> Dict[str, Any]:
+    return {
+        "image_filename": "input_image.png",
+        "prompt": params["prompt"],
+        "negative_prompt": params["negative_prompt"],
+        "seed": seed,
+        "steps": params["steps"],
+        "cfg": params["cfg"],
+        "fps": params["fps"],
+        "img_compression": params["img_compression"],
+        "i2v_strength_first": params["i2v_strength_first"],
+        "i2v_strength_second": params["i2v_strength_second"],
+        "width": params["width"],
+        "height": params["height"],
+        "longer_edge": max(params["width"], params["height"]),
+    }
+
+def _patch_workflow(workflow: Dict, plan: PatchPlan, values: Dict[str, Any]) -> Dict:
+    # plan comes from patch_plan(), so every node_id is known to exist
+    for node_id, assignments in plan:
+        inputs = workflow[node_id]["inputs"]
+        for input_key, value_key in assignments:
+            inputs[input_key] = values[value_key]
+    return workflow
+
+def modify_workflow_generated_audio(workflow: Dict, params: Dict) -> Dict:
+    logger.info("Configuring workflow for GENERATED AUDIO mode...")
+    values = _base_patch_values(params, _resolve_seed(params))
+    values["frame_count"] = params["frame_count"]
+    return _patch_workflow(workflow, patch_plan("generated_audio"), values)
 
+def modify_workflow_custom_audio(workflow: Dict, params: Dict, audio_duration: float,
+                                 audio_filename: str = "input_audio.mp3") -> Dict:
+    logger.info("Configuring workflow for CUSTOM AUDIO mode...")
+    values = _base_patch_values(params, _resolve_seed(params))
     fps = params["fps"]
     frame_count = int(audio_duration * fps) + 1
-    logger.info(f"Calculated frame count: {frame_count} ({audio_duration:.2f}s x {fps}fps)")
-
-    if "98" in workflow:
-        workflow["98"]["inputs"]["image"] = "input_image.png"
-    if "92:3" in workflow:
-        workflow["92:3"]["inputs"]["text"] = params["prompt"]
-    if "92:4" in workflow:
-        workflow["92:4"]["inputs"]["text"] = params.get("negative_prompt", DEFAULT_NEGATIVE_PROMPT)
-    for node_id in ["92:11", "92:67"]:
-        if node_id in workflow:
-            workflow[node_id]["inputs"]["noise_seed"] = seed
-    if "92:9" in workflow:
-        workflow["92:9"]["inputs"]["steps"] = params["steps"]
-    if "92:47" in workflow:
-        workflow["92:47"]["inputs"]["cfg"] = params["cfg"]
-    if "92:114" in workflow:
-        workflow["92:114"]["inputs"]["audio"] = "input_audio.mp3"
-    if "92:115" in workflow:
-        workflow["92:115"]["inputs"]["value"] = float(fps)
-    if "92:97" in workflow:
-        workflow["92:97"]["inputs"]["fps"] = fps
-    if "92:99" in workflow:
-        workflow["92:99"]["inputs"]["img_compression"] = params.get("img_compression", 33)
-    if "92:107" in workflow:
-        workflow["92:107"]["inputs"]["strength"] = params.get("i2v_strength_first", 1.0)
-    if "92:108" in workflow:
-        workflow["92:108"]["inputs"]["strength"] = params.get("i2v_strength_second", 0.7)
-    # Resolution - resize input image to requested dimensions
-    if "102" in workflow:
-        workflow["102"]["inputs"]["resize_type.width"] = params["width"]
-        workflow["102"]["inputs"]["resize_type.height"] = params["height"]
-    # Spatial upscaler - set longer edge to match requested dimensions
-    if "92:106" in workflow:
-        workflow["92:106"]["inputs"]["longer_edge"] = max(params["width"], params["height"])
-    return workflow
+    logger.info("Calculated frame count: %s (%.2fs x %sfps)", frame_count, audio_duration, fps)
+    values["fps_float"] = float(fps)
+    values["audio_filename"] = audio_filename
+    return _patch_workflow(workflow, patch_plan("custom_audio"), values)
 
-def queue_prompt(workflow: Dict) -> str:
+def connect_websocket(client_id: str) -> Optional[websocket.WebSocket]:
+    logger.info("Connecting to ComfyUI websocket...")
+    # The JSON parser rejects invalid UTF-8 itself, so skip websocket-client's
+    # pure-Python validation pass over every text frame
+    ws = websocket.WebSocket(skip_utf8_validation=True)
+    try:
+        ws.connect(f"{COMFYUI_WS_URL}?clientId={client_id}", timeout=30)
+    except Exception as e:
+        logger.warning("ComfyUI websocket unavailable, will poll /history instead: %s", e)
+        return None
+    return ws
+
+def queue_prompt(workflow: Dict, client_id: str) -> str:
     logger.info("Queueing prompt to ComfyUI...")
     try:
-        data = json.dumps({"prompt": workflow}).encode("utf-8")
-        req = urllib.request.Request(
-            f"{COMFYUI_URL}/prompt",
-            data=data,
-            headers={"Content-Type": "application/json"}
-        )
-        response = urllib.request.urlopen(req, timeout=30)
-        result = json.loads(response.read().decode("utf-8"))
+        data = json_dumps({"prompt": workflow, "client_id": client_id})
+        result = json_loads(comfyui_request("POST", "/prompt", body=data, timeout=30))
         prompt_id = result.get("prompt_id")
-        logger.info(f"Prompt queued with ID: {prompt_id}")
+        logger.info("Prompt queued with ID: %s", prompt_id)
         return prompt_id
     except Exception as e:
-        logger.error(f"Failed to queue prompt: {e}")
+        logger.error("Failed to queue prompt: %s", e)
         raise
 
-def wait_for_completion(prompt_id: str, timeout: int = 600) -> Dict:
-    logger.info(f"Waiting for completion (timeout: {timeout}s)...")
-    start_time = time.time()
+def get_history(prompt_id: str) -> Dict:
+    history = json_loads(comfyui_request("GET", f"/history/{prompt_id}", timeout=10))
+    return history.get(prompt_id, {})
+
+def _raise_on_history_error(history: Dict) -> None:
+    status = history.get("status", {})
+    if status.get("status_str") == "error":
+        error_msg = status.get("messages", [["Unknown error"]])[0]
+        logger.error("Workflow execution error: %s", error_msg)
+        raise RuntimeError(f"Workflow error: {error_msg}")
+
+def _wait_for_completion_event(
+    ws: websocket.WebSocket,
+    prompt_id: str,
+    start_time: float,
+    deadline: float,
+    on_output: Optional[Callable[[Dict], None]],
+) -> bool:
     last_progress = 0
-    while time.time() - start_time < timeout:
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        ws.settimeout(remaining)
         try:
-            response = urllib.request.urlopen(f"{COMFYUI_URL}/history/{prompt_id}", timeout=10)
-            history = json.loads(response.read().decode("utf-8"))
-            if prompt_id in history:
-                outputs = history[prompt_id].get("outputs", {})
-                status = history[prompt_id].get("status", {})
-                if status.get("status_str") == "error":
-                    error_msg = status.get("messages", [["Unknown error"]])[0]
-                    logger.error(f"Workflow execution error: {error_msg}")
-                    raise RuntimeError(f"Workflow error: {error_msg}")
-                if outputs:
-                    elapsed = time.time() - start_time
-                    logger.info(f"Generation completed in {elapsed:.1f}s")
-                    return outputs
+            # Raw frame bytes go straight to the JSON parser, skipping the
+            # str decode recv() would do first
+            opcode, message = ws.recv_data()
+        except websocket.WebSocketTimeoutException:
+            return False
+        if opcode != websocket.ABNF.OPCODE_TEXT:
+            # Binary frames carry latent previews
+            continue
+        msg = json_loads(message)
+        data = msg.get("data", {})
+        if data.get("prompt_id") != prompt_id:
+            continue
+        msg_type = msg.get("type")
+        if msg_type == "executing" and data.get("node") is None:
+            return True
+        elif msg_type == "executed" and on_output and data.get("output"):
+            on_output({data.get("node"): data["output"]})
+        elif msg_type == "execution_error":
+            error_msg = data.get("exception_message", "Unknown error")
+            logger.error("Workflow execution error in node %s: %s", data.get("node_id"), error_msg)
+            raise RuntimeError(f"Workflow error: {error_msg}")
+        elif msg_type == "progress":
             current_time = int(time.time() - start_time)
-            if current_time % 10 == 0 and current_time != last_progress:
-                logger.info(f"Progress: {current_time}s elapsed...")
+            if current_time // 10 != last_progress // 10:
+                logger.info("Progress: step %s/%s, %ss elapsed...", data.get("value"), data.get("max"), current_time)
                 last_progress = current_time
-        except urllib.error.URLError as e:
-            logger.debug(f"Status check error: {e}")
-        except RuntimeError:
-            raise
+
+def _poll_for_completion(prompt_id: str, start_time: float, deadline: float) -> Optional[Dict]:
+    delay = COMPLETION_POLL_INITIAL_DELAY
+    last_progress = 0
+    while time.time() < deadline:
+        try:
+            history = get_history(prompt_id)
         except Exception as e:
-            logger.debug(f"Status check error: {e}")
-        time.sleep(1)
-    logger.error(f"Generation timed out after {timeout}s")
-    raise TimeoutError(f"Generation timed out after {timeout} seconds")
+            logger.debug("Status check error: %s", e)
+        else:
+            _raise_on_history_error(history)
+            if history.get("outputs"):
+                return history
+        current_time = int(time.time() - start_time)
+        if current_time // 10 != last_progress // 10:
+            logger.info("Progress: %ss elapsed...", current_time)
+            last_progress = current_time
+        time.sleep(max(0.0, min(delay, deadline - time.time())))
+        delay = min(delay * 1.5, COMPLETION_POLL_MAX_DELAY)
+    return None
 
-def get_output_video(outputs: Dict) -> Optional[str]:
-    logger.info("Extracting output video...")
+def wait_for_completion(
+    ws: Optional[websocket.WebSocket],
+    prompt_id: str,
+    timeout: int = 600,
+    on_output: Optional[Callable[[Dict], None]] = None,
+) -> Dict:
+    logger.info("Waiting for completion (timeout: %ss)...", timeout)
+    start_time = time.time()
+    deadline = start_time + timeout
+    history: Optional[Dict] = None
+    if ws is not None:
+        try:
+            completed = _wait_for_completion_event(ws, prompt_id, start_time, deadline, on_output)
+        except (websocket.WebSocketConnectionClosedException, ConnectionError) as e:
+            logger.warning("ComfyUI websocket dropped, polling /history instead: %s", e)
+            ws = None
+        else:
+            if completed:
+                history = get_history(prompt_id)
+                _raise_on_history_error(history)
+    if ws is None:
+        history = _poll_for_completion(prompt_id, start_time, deadline)
+    if history is None:
+        logger.error("Generation timed out after %ss", timeout)
+        raise TimeoutError(f"Generation timed out after {timeout} seconds")
+    elapsed = time.time() - start_time
+    logger.info("Generation completed in %.1fs", elapsed)
+    return history.get("outputs", {})
+
+def _video_path_in(node_output: Dict) -> Optional[str]:
+    for key in OUTPUT_VIDEO_KEYS:
+        items = node_output.get(key)
+        if items is None:
+            continue
+        if not isinstance(items, list):
+            items = [items]
+        for item in items:
+            if isinstance(item, dict):
+                filename = item.get("filename")
+                subfolder = item.get("subfolder", "")
+            elif isinstance(item, str):
+                filename = item
+                subfolder = ""
+            else:
+                continue
+            if not filename:
+                continue
+            if subfolder:
+                filepath = f"/comfyui/output/{subfolder}/{filename}"
+            else:
+                filepath = f"/comfyui/output/{filename}"
+            if os.path.exists(filepath):
+                return filepath
+    return None
+
+def find_output_video(outputs: Dict) -> Optional[str]:
+    # The bundled templates save through one known node; only fall back to
+    # scanning every node for workflows that save elsewhere
+    preferred = outputs.get(OUTPUT_VIDEO_NODE)
+    if preferred:
+        filepath = _video_path_in(preferred)
+        if filepath:
+            return filepath
     for node_id, node_output in outputs.items():
-        for key in ["gifs", "videos", "video", "images", "files"]:
-            if key in node_output:
-                items = node_output[key]
-                if not isinstance(items, list):
-                    items = [items]
-                for item in items:
-                    if isinstance(item, dict):
-                        filename = item.get("filename")
-                        subfolder = item.get("subfolder", "")
-                    elif isinstance(item, str):
-                        filename = item
-                        subfolder = ""
-                    else:
-                        continue
-                    if not filename:
-                        continue
-                    if subfolder:
-                        filepath = f"/comfyui/output/{subfolder}/{filename}"
-                    else:
-                        filepath = f"/comfyui/output/{filename}"
-                    if os.path.exists(filepath):
-                        file_size = os.path.getsize(filepath)
-                        logger.info(f"Found output video: {filepath} ({file_size} bytes)")
-                        with open(filepath, "rb") as f:
-                            video_data = base64.b64encode(f.read()).decode("utf-8")
-                        return video_data
-    output_dir = "/comfyui/output"
-    if os.path.exists(output_dir):
-        for root, dirs, files in os.walk(output_dir):
-            for file in sorted(files, reverse=True):
-                if file.endswith(('.mp4', '.webm', '.gif', '.avi', '.mov')):
-                    filepath = os.path.join(root, file)
-                    file_size = os.path.getsize(filepath)
-                    logger.info(f"Found video file: {filepath} ({file_size} bytes)")
-                    with open(filepath, "rb") as f:
-                        video_data = base64.b64encode(f.read()).decode("utf-8")
-                    return video_data
+        if node_id == OUTPUT_VIDEO_NODE:
+            continue
+        filepath = _video_path_in(node_output)
+        if filepath:
+            return filepath
+    return None
+
+def read_video_base64(filepath: str) -> str:
+    file_size = os.path.getsize(filepath)
+    logger.info("Found output video: %s (%s bytes)", filepath, file_size)
+    # export_video has already rejected empty files, which mmap cannot map
+    with open(filepath, "rb") as f:
+        # Encode straight out of the page cache: the mapping is handed to
+        # b64encode as a buffer, so the raw video is never copied into a
+        # bytes object. The encoded bytes and their str decode are still
+        # two full-size allocations
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            encoded = b64.b64encode(mm)
+        # The output is read exactly once; keep it from crowding the page
+        # cache for the next job on a warm worker
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return encoded.decode("ascii")
+
+class OutputUploadError(RuntimeError):
+    """Uploading or presigning the output video failed."""
+
+def upload_video_to_s3(filepath: str, job_id: str) -> str:
+    if not S3_BUCKET:
+        raise RuntimeError("S3_BUCKET must be set to return video URLs")
+    from boto3.s3.transfer import TransferConfig
+    key = f"{S3_KEY_PREFIX}{job_id}/{os.path.basename(filepath)}"
+    file_size = os.path.getsize(filepath)
+    logger.info("Uploading output video %s (%s bytes) to s3://%s/%s...", filepath, file_size, S3_BUCKET, key)
+    client = s3_client()
+    try:
+        client.upload_file(
+            filepath,
+            S3_BUCKET,
+            key,
+            # upload_file streams parts from disk; capping concurrency bounds the
+            # buffered parts to max_concurrency * multipart_chunksize
+            Config=TransferConfig(
+                multipart_threshold=8 * 1024 * 1024,
+                multipart_chunksize=8 * 1024 * 1024,
+                max_concurrency=4,
+                use_threads=True,
+            ),
+        )
+        return client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": S3_BUCKET, "Key": key},
+            ExpiresIn=S3_PRESIGN_EXPIRY_SECONDS,
+        )
+    except Exception as e:
+        # S3UploadFailedError, ClientError and credential errors all mean
+        # the output could not be delivered, not that the worker is broken
+        raise OutputUploadError(f"Failed to upload output video to s3://{S3_BUCKET}/{key}: {e}") from e
+
+def export_video(filepath: str, job_id: str, return_format: str) -> Optional[Dict[str, str]]:
+    # A missing or zero-byte file means the save node produced nothing;
+    # report it as no output rather than a successful empty video
+    try:
+        file_size = os.path.getsize(filepath)
+    except OSError:
+        file_size = 0
+    if not file_size:
+        logger.warning("Output video %s is missing or empty", filepath)
+        return None
+    if return_format == "url":
+        return {"video_url": upload_video_to_s3(filepath, job_id)}
+    return {"video": read_video_base64(filepath)}
+
+def find_newest_output_video(since: float) -> Optional[str]:
+    # Only files written during this job count; anything older is left over
+    # from a previous job and must not be returned in its place. File mtimes
+    # come from the coarse kernel clock, so allow a little slack
+    newest, newest_mtime = None, since - 1.0
+    for filepath in glob.iglob("/comfyui/output/**/*", recursive=True):
+        if not filepath.endswith(VIDEO_EXTENSIONS):
+            continue
+        try:
+            mtime = os.path.getmtime(filepath)
+        except OSError:
+            continue
+        if mtime >= newest_mtime:
+            newest, newest_mtime = filepath, mtime
+    return newest
+
+def get_output_video(outputs: Dict, job_id: str, return_format: str, since: float = 0.0) -> Optional[Dict[str, str]]:
+    logger.info("Extracting output video...")
+    filepath = find_output_video(outputs) or find_newest_output_video(since)
+    if filepath:
+        return export_video(filepath, job_id, return_format)
     logger.warning("No output video found in results")
     return None
 
@@ -541,59 +1055,93 @@ def handler(job: Dict) -> Dict:
                 elapsed_s=round(time.time() - start_time, 3),
             )
 
+        return_format = job_input.get("return_format", DEFAULT_RETURN_FORMAT)
+        if return_format not in RETURN_FORMATS:
+            return _failure_response(
+                error_code="INVALID_INPUT",
+                error_message=f"Invalid return_format: {return_format!r} (expected one of {', '.join(RETURN_FORMATS)})",
+                retryable=False,
+                infra_error=False,
+                elapsed_s=round(time.time() - start_time, 3),
+            )
+        if return_format == "url" and not S3_BUCKET:
+            return _failure_response(
+                error_code="OUTPUT_NOT_CONFIGURED",
+                error_message="return_format 'url' requires S3_BUCKET to be set on the worker",
+                retryable=False,
+                infra_error=False,
+                elapsed_s=round(time.time() - start_time, 3),
+            )
+
         has_custom_audio = "audio" in job_input and job_input["audio"]
         mode = "custom_audio" if has_custom_audio else "generated_audio"
-        logger.info(f"Mode: {mode.upper()}")
-
-        params = {
-            "image": job_input["image"],
-            "prompt": job_input["prompt"],
-            "negative_prompt": job_input.get("negative_prompt", DEFAULT_NEGATIVE_PROMPT),
-            "width": job_input.get("width", DEFAULT_PARAMS["width"]),
-            "height": job_input.get("height", DEFAULT_PARAMS["height"]),
-            "frame_count": job_input.get("frame_count", DEFAULT_PARAMS["frame_count"]),
-            "steps": job_input.get("steps", DEFAULT_PARAMS["steps"]),
-            "cfg": job_input.get("cfg", DEFAULT_PARAMS["cfg"]),
-            "fps": job_input.get("fps", DEFAULT_PARAMS["fps"]),
-            "seed": job_input.get("seed", DEFAULT_PARAMS["seed"]),
-            "timeout": job_input.get("timeout", DEFAULT_PARAMS["timeout"]),
-            "img_compression": job_input.get("img_compression", DEFAULT_PARAMS["img_compression"]),
-            "i2v_strength_first": job_input.get("i2v_strength_first", DEFAULT_PARAMS["i2v_strength_first"]),
-            "i2v_strength_second": job_input.get("i2v_strength_second", DEFAULT_PARAMS["i2v_strength_second"])
-        }
+        logger.info("Mode: %s", mode.upper())
 
-        logger.info("Input parameters:")
-        logger.info(f"  Prompt: {params['prompt'][:100]}...")
-        logger.info(f"  Resolution: {params['width']}x{params['height']}, longer_edge={max(params['width'], params['height'])}")
-        logger.info(f"  Steps: {params['steps']}, CFG: {params['cfg']}, FPS: {params['fps']}")
-        logger.info(f"  Seed: {params['seed'] or 'random'}")
-        logger.info(f"  I2V Strength: first={params['i2v_strength_first']}, second={params['i2v_strength_second']}")
+        # One merge of the recognised job fields over the defaults; writes
+        # (e.g. the random seed) land in this job's own dict
+        params = dict(DEFAULT_PARAMS)
+        params.update((key, job_input[key]) for key in job_input.keys() & JOB_PARAM_KEYS)
 
-        if not wait_for_comfyui():
-            return _infra_failure_response(
-                error_code="COMFYUI_BOOT_TIMEOUT",
-                error_message="ComfyUI server not available",
-                retryable=True,
-                elapsed_s=round(time.time() - start_time, 3),
-                refresh_worker=True,
-            )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Input parameters:")
+            logger.info("  Prompt: %s...", params["prompt"][:100])
+            logger.info("  Resolution: %sx%s, longer_edge=%s", params["width"], params["height"], max(params["width"], params["height"]))
+            logger.info("  Steps: %s, CFG: %s, FPS: %s", params["steps"], params["cfg"], params["fps"])
+            logger.info("  Seed: %s", params["seed"] or "random")
+            logger.info("  I2V Strength: first=%s, second=%s", params["i2v_strength_first"], params["i2v_strength_second"])
+
+        workflow_name = "custom_audio" if has_custom_audio else "generated_audio"
+        # The readiness wait, input decodes and workflow copy are independent;
+        # overlap them so the decodes are hidden behind a cold-start wait
+        with ThreadPoolExecutor(max_workers=4) as prep:
+            ready_future = prep.submit(wait_for_comfyui)
+            image_future = prep.submit(save_input_image, params["image"])
+            audio_future = prep.submit(save_input_audio, job_input["audio"]) if has_custom_audio else None
+            workflow_future = prep.submit(load_workflow, workflow_name)
+            if not ready_future.result():
+                return _infra_failure_response(
+                    error_code="COMFYUI_BOOT_TIMEOUT",
+                    error_message="ComfyUI server not available",
+                    retryable=True,
+                    elapsed_s=round(time.time() - start_time, 3),
+                    refresh_worker=True,
+                )
+            image_future.result()
+            workflow = workflow_future.result()
 
-        save_input_image(params["image"])
+            audio_path, audio_duration = audio_future.result() if audio_future else (None, None)
 
-        audio_duration = None
         if has_custom_audio:
-            _, audio_duration = save_input_audio(job_input["audio"])
-            workflow = load_workflow("custom_audio")
-            workflow = modify_workflow_custom_audio(workflow, params, audio_duration)
+            workflow = modify_workflow_custom_audio(
+                workflow, params, audio_duration, os.path.basename(audio_path)
+            )
         else:
-            workflow = load_workflow("generated_audio")
             workflow = modify_workflow_generated_audio(workflow, params)
 
-        prompt_id = queue_prompt(workflow)
-        outputs = wait_for_completion(prompt_id, params["timeout"])
-        video_data = get_output_video(outputs)
+        client_id = str(uuid.uuid4())
+        ws = connect_websocket(client_id)
+        video_future: Optional[Future] = None
+        with ThreadPoolExecutor(max_workers=1) as video_exporter:
+            # Start exporting the video as soon as the save node reports it,
+            # overlapping the encode/upload with ComfyUI's prompt teardown
+            def prefetch_video(node_outputs: Dict) -> None:
+                nonlocal video_future
+                filepath = find_output_video(node_outputs)
+                if video_future is None and filepath:
+                    video_future = video_exporter.submit(export_video, filepath, job_id, return_format)
+
+            try:
+                prompt_id = queue_prompt(workflow, client_id)
+                outputs = wait_for_completion(ws, prompt_id, params["timeout"], on_output=prefetch_video)
+            finally:
+                if ws is not None:
+                    ws.close()
+            if video_future is not None:
+                video_output = video_future.result()
+            else:
+                video_output = get_output_video(outputs, job_id, return_format, since=start_time)
 
-        if not video_data:
+        if not video_output:
             return _failure_response(
                 error_code="NO_OUTPUT_VIDEO",
                 error_message="No video output generated",
@@ -604,10 +1152,10 @@ def handler(job: Dict) -> Dict:
 
         elapsed = time.time() - start_time
         log_section("JOB COMPLETED SUCCESSFULLY")
-        logger.info(f"Total time: {elapsed:.1f}s")
+        logger.info("Total time: %.1fs", elapsed)
 
         result = _success_response(
-            video_data=video_data,
+            video_output=video_output,
             seed=params["seed"],
             elapsed_s=round(elapsed, 3),
             extra={
@@ -634,9 +1182,9 @@ def handler(job: Dict) -> Dict:
 
     except Exception as e:
         elapsed = time.time() - start_time
-        logger.error(f"Job failed after {elapsed:.1f}s: {str(e)}")
+        # Format the traceback once; it is both logged and returned
         trace = traceback.format_exc()
-        logger.error(trace)
+        logger.error("Job failed after %.1fs: %s\n%s", elapsed, e, trace)
 
         error_code, error_message, retryable, infra_error, refresh_worker = _classify_exception(e)
         elapsed_s = round(elapsed, 3)
@@ -659,8 +1207,13 @@ def handler(job: Dict) -> Dict:
             extra={"traceback": trace},
         )
 
+# Worker startup: every import-time side effect lives here
+start_readiness_probe()
+ensure_io_directories()
+preload_workflows()
+
 if __name__ == "__main__":
     log_section("LTX-2 VIDEO SERVERLESS HANDLER STARTING")
-    logger.info(f"ComfyUI URL: {COMFYUI_URL}")
-    logger.info(f"Supported modes: generated_audio, custom_audio")
+    logger.info("ComfyUI URL: %s", COMFYUI_URL)
+    logger.info("Supported modes: generated_audio, custom_audio")
     runpod.serverless.start({"handler": handler})